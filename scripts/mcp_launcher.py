@@ -1,10 +1,10 @@
+import select
 import subprocess
 import os
 import sys
 import time
 import signal
 import socket
-from typing import List
 
 # --- Configuration ---
 SERVER_HOST = "127.0.0.1"
@@ -15,17 +15,134 @@ SERVER_HOST = "127.0.0.1"
 LOG_FILE_PATH_TEMPLATE = "uvicorn_mcp_server_{pid}.log"
 # This file will be created in the directory where uvx runs the script.
 
+# Uvicorn command line, built once at import time. We use the Python
+# executable from the uvx environment (sys.executable) and run Uvicorn as a
+# module (-m uvicorn) to guarantee it's available. The launcher's pre-bound
+# socket fd is appended per launch.
+UVICORN_CMD = [
+    sys.executable,
+    "-m",
+    "uvicorn",
+    "server.app:app",
+    # uvicorn[standard] is a project dependency, so uvloop and httptools are
+    # always present; request them explicitly rather than relying on "auto".
+    "--loop",
+    "uvloop",
+    "--http",
+    "httptools",
+    "--fd",
+]
+
 # Global variable to store the server process and its PID for signal handling
 SERVER_PROCESS = None
+PROXY_PROCESS = None
 LOG_FILE = None
 LOG_FILE_PATH = None
+# Set by signal_handler; checked by the main flow after the proxy exits.
+SHUTDOWN_SIGNAL = None
+
+
+def create_server_socket():
+    """Binds the server port, without listening, and returns the socket.
+
+    The port is taken from $MCP_PORT when set (deterministic launches, e.g.
+    attaching a debugger or curl-ing a known URL across restarts); otherwise
+    the OS assigns a free one. The socket is bound but deliberately NOT
+    listening: uvicorn (via asyncio's create_server) calls listen() on the
+    --fd socket itself, so the port stays reserved from the moment we bind
+    it, yet connects are refused until the server is actually up - which is
+    what lets the readiness probe detect startup failures.
+    """
+    # "or 0" also covers MCP_PORT set-but-empty (common in CI).
+    port = int(os.environ.get("MCP_PORT") or 0)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Without SO_REUSEADDR a pinned $MCP_PORT cannot be rebound within the
+    # TIME_WAIT window of the previous run, failing relaunch with EADDRINUSE.
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((SERVER_HOST, port))
+    return s
+
 
+def _wait_until_listening(host, port, deadline=10.0):
+    """Polls until the server accepts a TCP connection, or the deadline expires.
+
+    Returns True once a connection succeeds. Raises RuntimeError (with the
+    uvicorn log contents) if the server process dies before listening.
+    """
+    delay = 0.01
+    start = time.monotonic()
+    while time.monotonic() - start < deadline:
+        try:
+            s = socket.create_connection((host, port), timeout=0.2)
+            s.close()
+            return True
+        except (ConnectionRefusedError, OSError):
+            pass
+
+        # Bail out early if the server already died instead of waiting out the deadline.
+        if SERVER_PROCESS and SERVER_PROCESS.poll() is not None:
+            # The server is dead, so rewinding the shared file offset is safe.
+            LOG_FILE.seek(0)
+            error_output = LOG_FILE.read()
+            raise RuntimeError(
+                f"Server failed to start. Exit code: {SERVER_PROCESS.returncode}. Output from {LOG_FILE_PATH}:\n{error_output}"
+            )
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return False
+
+
+def _wait_for_exit(process, timeout):
+    """Waits up to `timeout` seconds for `process` to exit.
+
+    Uses os.pidfd_open + select on Linux 5.3+ so the wait is event-driven
+    (the kernel wakes us the moment the child exits) instead of sleeping a
+    fixed interval. Falls back to Popen.wait(timeout) elsewhere.
+    Returns True if the process exited within the timeout.
+    """
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except ProcessLookupError:
+            return process.poll() is not None  # Already reaped or gone
+        except OSError:
+            pass  # Kernel <5.3 or seccomp rejects pidfds; timed wait below
+        else:
+            try:
+                select.select([pidfd], [], [], timeout)
+            finally:
+                os.close(pidfd)
+            return process.poll() is not None
+
+    try:
+        process.wait(timeout=timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
 
-def find_free_port():
-    """Finds and returns an available TCP port on the host."""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((SERVER_HOST, 0))
-        return s.getsockname()[1]
+
+def _signal_server(process, sig):
+    """Delivers `sig` to the uvicorn server, race-free where possible.
+
+    Uvicorn runs single-process here (no --workers, no --reload), so on
+    Linux 5.1+ we signal it through a pidfd, which cannot mis-deliver if
+    the PID has been recycled. Elsewhere we fall back to signalling its
+    process group, as before.
+    """
+    if hasattr(signal, "pidfd_send_signal"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+            try:
+                signal.pidfd_send_signal(pidfd, sig)
+            finally:
+                os.close(pidfd)
+            return
+        except ProcessLookupError:
+            raise  # Already terminated; the caller handles this
+        except OSError:
+            pass  # Kernel <5.1 or seccomp rejects pidfds; use the group kill
+    os.killpg(os.getpgid(process.pid), sig)
 
 
 def cleanup_server():
@@ -46,21 +163,16 @@ def cleanup_server():
         )
 
         try:
-            pgid = os.getpgid(SERVER_PROCESS.pid)
+            # 1. Send SIGTERM (Graceful Kill)
+            _signal_server(SERVER_PROCESS, signal.SIGTERM)
 
-            # 1. Send SIGTERM (Graceful Kill) to the entire process group
-            os.killpg(pgid, signal.SIGTERM)
-
-            # Wait briefly
-            time.sleep(1)
-
-            # 2. Check if the process is still alive and use SIGKILL if necessary
-            if SERVER_PROCESS.poll() is None:
+            # 2. Wait (event-driven) for the exit, escalating to SIGKILL if necessary
+            if not _wait_for_exit(SERVER_PROCESS, timeout=1):
                 print(
-                    f"Graceful shutdown failed. Forcing kill on PGID {pgid}...",
+                    f"Graceful shutdown failed. Forcing kill on PID {SERVER_PROCESS.pid}...",
                     file=sys.stderr,
                 )
-                os.killpg(pgid, signal.SIGKILL)
+                _signal_server(SERVER_PROCESS, signal.SIGKILL)
                 SERVER_PROCESS.wait(timeout=1)
             else:
                 print("Shutdown successful.", file=sys.stderr)
@@ -72,90 +184,102 @@ def cleanup_server():
 
 
 def signal_handler(sig, frame):
-    """Handler for SIGINT (Ctrl+C) and SIGTERM (Client kill)."""
-    cleanup_server()
-    # Re-raise the signal to allow the main script to exit cleanly
-    sys.exit(0)
+    """Handler for SIGINT (Ctrl+C) and SIGTERM (Client kill).
 
+    Does the bare minimum: records the signal and nudges the proxy to exit.
+    Running cleanup_server() (prints, waits, kills) directly in the handler
+    could re-enter whatever main-line code the signal interrupted; instead,
+    the main flow's PROXY_PROCESS.wait() returns once the proxy dies and the
+    finally block performs cleanup exactly once, on the main stack.
+    """
+    global SHUTDOWN_SIGNAL
+    SHUTDOWN_SIGNAL = sig
+    if PROXY_PROCESS and PROXY_PROCESS.poll() is None:
+        PROXY_PROCESS.terminate()
 
-def launch_server_and_proxy(proxy_args: List[str] = None):
+
+def launch_server_and_proxy(proxy_args: list[str] | None = None):
     """
     Starts the FastAPI server on a dynamic port, runs the proxy, and ensures server shutdown.
     It uses sys.executable to ensure both Uvicorn and the dba-mcp-proxy
     are run within the temporary, isolated environment created by uvx.
     """
-    global SERVER_PROCESS, LOG_FILE, LOG_FILE_PATH
+    global SERVER_PROCESS, PROXY_PROCESS, LOG_FILE, LOG_FILE_PATH
     proxy_exit_code = 1
 
     # --- Dynamic Port and Log File Allocation ---
-    server_port = find_free_port()
+    server_socket = create_server_socket()
+    server_port = server_socket.getsockname()[1]
     server_url = f"http://{SERVER_HOST}:{server_port}"
     LOG_FILE_PATH = LOG_FILE_PATH_TEMPLATE.format(pid=os.getpid())
 
-    print(f"Starting FastAPI MCP server in background on {server_url}...")
-    # 1. Register signal handlers immediately
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    print(f"Uvicorn logs redirected to: {LOG_FILE_PATH}")
+    # Diagnostics go to stderr: the launcher's stdout is inherited by the
+    # proxy (and thus the MCP client's JSON-RPC channel) and must stay clean.
+    print(
+        f"Starting FastAPI MCP server in background on {server_url} "
+        f"(uvicorn logs redirected to: {LOG_FILE_PATH})...",
+        file=sys.stderr,
+    )
+    # 1. Register signal handlers immediately, before anything is spawned
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal_handler)
 
     try:
         # 1. Start the Uvicorn/FastAPI server (Layer 1)
-        # We use the Python executable from the uvx environment (sys.executable)
-        # and run Uvicorn as a module (-m uvicorn) to guarantee it's available.
-        LOG_FILE = open(LOG_FILE_PATH, "w")
+        # "w+" so the startup failure path can read the log back through
+        # this same handle instead of reopening the file.
+        LOG_FILE = open(LOG_FILE_PATH, "w+")
         SERVER_PROCESS = subprocess.Popen(
-            [
-                sys.executable,
-                "-m",
-                "uvicorn",
-                "server.app:app",
-                "--host",
-                SERVER_HOST,
-                "--port",
-                str(server_port),
-            ],
+            UVICORN_CMD + [str(server_socket.fileno())],
             stdout=LOG_FILE,
             stderr=subprocess.STDOUT,
-            preexec_fn=os.setsid,
+            start_new_session=True,
+            pass_fds=(server_socket.fileno(),),
         )
+        # Uvicorn now owns its copy of the (bound, not yet listening) fd;
+        # close ours. The port only starts accepting once uvicorn listens.
+        server_socket.close()
 
-        time.sleep(2)  # Give the server a moment to start
-
-        if SERVER_PROCESS.poll() is not None:
-            # Try to read output to diagnose failure. Close the file first.
-            LOG_FILE.close()
-            with open(LOG_FILE_PATH, "r") as f:
-                error_output = f.read()
+        # Wait for uvicorn to actually accept connections rather than sleeping
+        # a fixed amount; fast boots proceed immediately, slow ones get 10s.
+        if not _wait_until_listening(SERVER_HOST, server_port):
             raise RuntimeError(
-                f"Server failed to start. Exit code: {SERVER_PROCESS.returncode}. Output from {LOG_FILE_PATH}:\n{error_output}"
+                f"Server did not start listening on {server_url} within 10s. See {LOG_FILE_PATH}."
             )
 
-        print(f"FastAPI server started with PID {SERVER_PROCESS.pid}.")
-
         # 2. Run the dba-mcp-proxy (Layer 2 - The blocking client call)
-        print("Executing the dba-mcp-proxy...")
-        os.environ["DATABRICKS_APP_URL"] = server_url
-
         # --- Dynamic URL for Proxy ---
         proxy_cmd = ["dba-mcp-proxy"] + (proxy_args or [])
         proxy_cmd.extend(["--databricks-app-url", server_url])
 
-        print(f"Proxy Command: {' '.join(proxy_cmd)}")
+        print(
+            f"FastAPI server started with PID {SERVER_PROCESS.pid}.\n"
+            f"Executing the dba-mcp-proxy: {proxy_cmd!r}",
+            file=sys.stderr,
+        )
 
+        # No stdio arguments: the proxy inherits the launcher's actual stdin/
+        # stdout/stderr file descriptors, so MCP traffic flows client<->proxy
+        # without any redirection in between. The app URL travels via env=
+        # rather than mutating the launcher's own os.environ.
         PROXY_PROCESS = subprocess.Popen(
             proxy_cmd,
-            stdin=sys.stdin,
-            stdout=sys.stdout,
-            stderr=sys.stderr,
+            env={**os.environ, "DATABRICKS_APP_URL": server_url},
         )
 
+        # If a signal arrived before PROXY_PROCESS was assigned, the handler
+        # had nothing to terminate; honor the pending shutdown now instead of
+        # letting the proxy run its full lifetime.
+        if SHUTDOWN_SIGNAL is not None:
+            PROXY_PROCESS.terminate()
+
         # Block and wait for the proxy to finish (client closes connection or sends signal)
         proxy_exit_code = PROXY_PROCESS.wait()
 
-    except SystemExit as e:
-        # Catch the exit from the signal handler and honor it
-        sys.exit(e.code)
+        # A trapped signal is a clean shutdown, not a proxy failure.
+        if SHUTDOWN_SIGNAL is not None:
+            proxy_exit_code = 0
+
     except Exception as e:
         print(f"An error occurred: {e}", file=sys.stderr)
         proxy_exit_code = 1